@@ -19,17 +19,104 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import atexit
+import contextlib
 import os
-import shutil
 import sys
-from typing import Iterable, List, Optional
+import tempfile
+import traceback
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional
+
+from termcolor import colored
 
 from shut.model import PackageModel
 from shut.model.target import TargetId
+from shut.utils.fs import remove_directory
 from shut.utils.io.sp import subprocess_trimmed_call
 from .core import Builder, BuilderProvider, register_builder_provider
 
 
+def _reset_distutils_state() -> bool:
+  """
+  Resets module-level state of distutils that would otherwise carry over from one in-process
+  run of a `setup.py` to the next. `mkpath()` remembers the directories it created and will
+  not create them again, even after they have been removed (eg. `dist/` after a build). Older
+  versions keep that cache in `_path_created`, newer ones in `SkipRepeatAbsolutePaths`.
+
+  Returns #False if distutils is loaded but its cache could not be found, in which case the
+  `setup.py` must not be run in-process.
+  """
+
+  for name in ('distutils.dir_util', 'setuptools._distutils.dir_util'):
+    module = sys.modules.get(name)
+    if module is None:
+      continue
+    path_created = getattr(module, '_path_created', None)
+    path_cache = getattr(module, 'SkipRepeatAbsolutePaths', None)
+    if path_created is not None:
+      path_created.clear()
+    elif path_cache is not None and hasattr(path_cache, 'instance'):
+      path_cache.clear()
+    elif path_cache is None:
+      return False
+  return True
+
+
+def _run_setup_file() -> int:
+  """
+  Runs the `setup.py` file in the current working directory as the main module and returns
+  the exit code that the Python interpreter would have exited with. Files that a generated
+  `setup.py` copies into the package temporarily (see #shut.renderers.setuptools) are removed
+  once it is done rather than when the interpreter exits.
+  """
+
+  filename = os.path.abspath('setup.py')
+  namespace: Dict[str, Any] = {'__name__': '__main__', '__file__': filename}
+  try:
+    with open(filename, 'rb') as fp:
+      code = compile(fp.read(), filename, 'exec')
+    exec(code, namespace)
+  except SystemExit as exc:
+    if exc.code is None or isinstance(exc.code, int):
+      return exc.code or 0
+    print(exc.code, file=sys.stderr)
+    return 1
+  except Exception:
+    traceback.print_exc()
+    return 1
+  finally:
+    cleanup = namespace.get('_tempcopy_cleanup')
+    if callable(cleanup):
+      atexit.unregister(cleanup)
+      cleanup()
+  return 0
+
+
+@contextlib.contextmanager
+def _redirect_output_fds(stdout: BinaryIO, stderr: BinaryIO) -> Iterator[None]:
+  """
+  Redirects the standard output and error of the process into the files *stdout* and *stderr*
+  on the file descriptor level, capturing the output of child processes and C extensions as
+  well as that written through #sys.stdout and #sys.stderr.
+  """
+
+  sys.stdout.flush()
+  sys.stderr.flush()
+  saved_fds = os.dup(1), os.dup(2)
+  try:
+    os.dup2(stdout.fileno(), 1)
+    os.dup2(stderr.fileno(), 2)
+    with open(1, 'w', encoding='utf8', closefd=False) as out, \
+        open(2, 'w', encoding='utf8', closefd=False) as err, \
+        contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+      yield
+  finally:
+    os.dup2(saved_fds[0], 1)
+    os.dup2(saved_fds[1], 2)
+    os.close(saved_fds[0])
+    os.close(saved_fds[1])
+
+
 class SetuptoolsBuilder(Builder):
   """
   Internal. Implements building a Python package.
@@ -47,14 +134,14 @@ class SetuptoolsBuilder(Builder):
     self,
     id_: TargetId,
     description: str,
-    output_files: List[str],
+    output_files: Iterable[str],
     package_directory: str,
     build_type: str,
     args: List[str],
   ) -> None:
     self._id = id_
     self.description = description
-    self.output_files = output_files
+    self.output_files = tuple(output_files)
     self.package_directory = package_directory
     self.build_type = build_type
     self.args = args
@@ -71,7 +158,7 @@ class SetuptoolsBuilder(Builder):
   ) -> 'SetuptoolsBuilder':
     py = 'py2.py3' if package.is_universal() else ('py' + sys.version[0])
     filename = f'{package.name.replace("-", "_")}-{package.version}-{py}-none-any.whl'
-    return cls(id_, description, [filename], package.get_directory(), 'bdist_wheel', [])
+    return cls(id_, description, (filename,), package.get_directory(), 'bdist_wheel', [])
 
   @classmethod
   def sdist(
@@ -85,12 +172,43 @@ class SetuptoolsBuilder(Builder):
     return cls(
       id_,
       description,
-      [f'{package.name}-{package.version}{cls._FORMATS_MAP[f]}' for f in formats],
+      (f'{package.name}-{package.version}{cls._FORMATS_MAP[f]}' for f in formats),
       package.get_directory(),
       'sdist',
       ['--format', ','.join(formats)],
     )
 
+  def _run_setup_in_process(self, verbose: bool) -> int:
+    """
+    Runs the `setup.py` of the package in the current interpreter, which saves the startup of
+    a new Python process and the import of setuptools. Like #subprocess_trimmed_call(), only
+    the error output is shown unless *verbose* is enabled. Returns the exit code.
+    """
+
+    with contextlib.ExitStack() as stack:
+      cwd, argv, path = os.getcwd(), sys.argv, sys.path[:]
+      os.chdir(self.package_directory)
+      stack.callback(os.chdir, cwd)
+      sys.argv = ['setup.py', self.build_type] + self.args
+      stack.callback(setattr, sys, 'argv', argv)
+      sys.path.insert(0, os.getcwd())
+      stack.callback(sys.path.__setitem__, slice(None), path)
+
+      if verbose:
+        return _run_setup_file()
+
+      with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        with _redirect_output_fds(stdout, stderr):
+          res = _run_setup_file()
+        stderr.seek(0)
+        errors = stderr.read().decode('utf8', 'replace')
+
+    for line in errors.splitlines():
+      if line:
+        print(f'  {colored(line, "red")}')
+
+    return res
+
   # Builder Overrides
 
   def get_description(self) -> Optional[str]:
@@ -104,28 +222,31 @@ class SetuptoolsBuilder(Builder):
     python = os.getenv('PYTHON', sys.executable)
     dist_directory = os.path.join(self.package_directory, 'dist')
     dist_exists = os.path.exists(dist_directory)
-    command = [python, 'setup.py', self.build_type] + self.args
 
-    res = subprocess_trimmed_call(command, cwd=self.package_directory)
+    if python == sys.executable and _reset_distutils_state():
+      res = self._run_setup_in_process(verbose)
+    else:
+      command = [python, 'setup.py', self.build_type] + self.args
+      res = subprocess_trimmed_call(command, cwd=self.package_directory, verbose=verbose)
     if res != 0:
       return False
 
     # Make sure the files end up in the correct directory.
+    # os.replace() overwrites an existing destination, so no stat calls are needed upfront.
     for filename in self.output_files:
-      src = next(filter(os.path.isfile, [
-        os.path.join(dist_directory, filename),
-        os.path.join(dist_directory, filename.lower())]), None)
-      if not src:
-        raise RuntimeError('{} not produced by setup.py {}'.format(filename, self.build_type))
       dst = os.path.join(build_directory, filename)
-      if src != dst:
-        if os.path.isfile(dst):
-          os.remove(dst)
-        os.rename(src, dst)
+      for src in (os.path.join(dist_directory, filename), os.path.join(dist_directory, filename.lower())):
+        try:
+          os.replace(src, dst)
+          break
+        except FileNotFoundError:
+          pass
+      else:
+        raise RuntimeError('{} not produced by setup.py {}'.format(filename, self.build_type))
 
     # Cleanup after yourself.
     if not dist_exists:
-      shutil.rmtree(dist_directory)
+      remove_directory(dist_directory)
 
     return True
 
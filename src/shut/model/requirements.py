@@ -42,10 +42,14 @@ class VersionSelector(object):
 
   ANY: 'VersionSelector'
 
+  #: Matches a semver range selector (`^X.Y.Z` or `~X.Y.Z`) in the selector string.
+  _RANGE_SELECTOR_REGEX = re.compile(r'[~^](\d+\.\d+(\.\d+)?[.\-\w]*)')
+
   def __init__(self, selector):
     if isinstance(selector, VersionSelector):
       selector = selector._string
     self._string = selector.strip()
+    self._setuptools: Optional[str] = None
 
   def __str__(self):
     return str(self._string)
@@ -71,13 +75,19 @@ class VersionSelector(object):
     - `^X.Y.Z` -> `>=X.Y.Z,<X+1.0.0`
     - `~X.Y.Z` -> `>=X.Y.Z,<X.Y+1.0`
     - `X.Y.Z -> ==X.Y.Z`
+
+    The result is computed only once per selector.
     """
 
+    if self._setuptools is None:
+      self._setuptools = self._to_setuptools()
+    return self._setuptools
+
+  def _to_setuptools(self) -> str:
     # Poor-mans test if this looks like the form 'X.Y.Z' without anything around it.
     if not ',' in self._string and self._string[0].isdigit():
       return '==' + self._string
 
-    regex = r'[~^](\d+\.\d+(\.\d+)?[.\-\w]*)'
     def sub(match):
       index = {'^': 0, '~': 1}[match.group(0)[0]]
       max_version = match.group(1).split('.')[:3]
@@ -91,7 +101,7 @@ class VersionSelector(object):
       return '>={},<{}'.format(match.group(1), '.'.join(max_version))
 
     s = self._string + '.0' * (3 - self._string.count('.') - 1)
-    return re.sub(regex, sub, s)
+    return self._RANGE_SELECTOR_REGEX.sub(sub, s)
 
   def is_semver_selector(self) -> bool:
     return self._string and self._string[0] in '^~' and ',' not in self._string
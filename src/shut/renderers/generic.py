@@ -26,6 +26,9 @@ from shut.model import AbstractProjectModel, MonorepoModel
 from shut.utils.io.virtual import VirtualFiles
 from .core import Renderer, get_version_refs, register_renderer, VersionRef
 
+#: Regular expression to find the version number in a package or monorepo configuration file.
+_VERSION_REGEX = re.compile(r'^\s*version\s*:\s*[\'"]?(.*?)[\'"]?\s*(#.*)?$', re.S | re.M)
+
 
 class GenericRenderer(Renderer[AbstractProjectModel]):
 
@@ -39,9 +42,8 @@ class GenericRenderer(Renderer[AbstractProjectModel]):
     assert obj.project
 
     # Return a reference to the version number in the package or monorepo model.
-    regex = '^\s*version\s*:\s*[\'"]?(.*?)[\'"]?\s*(#.*)?$'
     with open(obj.filename) as fp:
-      match = re.search(regex, fp.read(), re.S | re.M)
+      match = _VERSION_REGEX.search(fp.read())
       if match:
         yield VersionRef(obj.filename, match.start(1), match.end(1), match.group(1))
 
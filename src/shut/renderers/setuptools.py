@@ -27,11 +27,11 @@ import os
 import posixpath
 import re
 import textwrap
-from typing import Dict, Iterable, List, Optional, TextIO, Tuple
+from typing import Dict, Iterable, List, Match, Optional, Pattern, TextIO, Tuple
 
 import nr.fs
 
-from shut.model.package import PackageModel, Include, Exclude
+from shut.model.package import PackageModel, PythonPackageMetadata, Include, Exclude
 from shut.model.requirements import RequirementsList
 from shut.utils.io.virtual import VirtualFiles
 from .core import Renderer, register_renderer, VersionRef
@@ -45,9 +45,168 @@ GENERATED_FILE_REMARK = '''
 
 _ReadmeStatus = collections.namedtuple('ReadmeStatus', 'path,runtime_path,outside')
 
+#: Regular expressions to find the version number in the `setup.py` and the package entry file.
+_SETUP_VERSION_REGEX = re.compile(r'^\s*version\s*=\s*[\'"]([^\'"]+)[\'"]', re.M)
+_PACKAGE_VERSION_REGEX = re.compile(r'^__version__\s*=\s*[\'"]([^\'"]+)[\'"]', re.M)
+
+#: Matches single newlines and paragraph breaks in a package description.
+_DESCRIPTION_NEWLINE_REGEX = re.compile(r'\n\n?')
+
+# Code templates for the generated setup.py file.
+
+_ENTRYPOINT_GROUP_LINE = '    {!r}: ['.format
+_ENTRYPOINT_ITEM_LINE = '      {},'.format
+
+_SETUP_IMPORTS_CODE = textwrap.dedent('''
+  import io
+  import os
+  import setuptools
+  import sys
+''').lstrip()
+
+_RUN_HOOKS_CODE = textwrap.dedent('''
+  def _run_hooks(event):
+    import subprocess, shlex, os
+    def _shebang(fn):
+      with open(fn) as fp:
+        line = fp.readline()
+        if line.startswith('#'):
+          return shlex.split(line[1:].strip())
+        return []
+    for hook in install_hooks:
+      if not hook['event'] or hook['event'] == event:
+        command = hook['command']
+        if command[0].endswith('.py') or 'python' in _shebang(command[0]):
+          command.insert(0, sys.executable)
+        env = os.environ.copy()
+        env['SHUT_INSTALL_HOOK_EVENT'] = event
+        res = subprocess.call(command, env=env)
+        if res != 0:
+          raise RuntimeError('command {!r} returned exit code {}'.format(command, res))
+''')
+
+_INSTALL_COMMAND_CODE = textwrap.dedent('''
+  class install_command(_install_command):
+    def run(self):
+      _run_hooks('install')
+      super(install_command, self).run()
+      _run_hooks('post-install')
+''')
+
+_DEVELOP_COMMAND_CODE = textwrap.dedent('''
+  class develop_command(_develop_command):
+    def run(self):
+      _run_hooks('develop')
+      super(develop_command, self).run()
+      _run_hooks('post-develop')
+''')
+
+#: The SetuptoolsBuilder calls `_tempcopy_cleanup()` itself when it runs the setup.py in-process.
+_TEMPCOPY_FUNCTION_CODE = textwrap.dedent('''
+  _tempcopy_files = []
+
+  def _tempcopy(src, dst):
+    import atexit, shutil
+    if not os.path.isfile(dst):
+      if not os.path.isfile(src):
+        print('warning: source file "{}" for destination "{}" does not exist'.format(src, dst))
+        return
+      shutil.copyfile(src, dst)
+      if not _tempcopy_files:
+        atexit.register(_tempcopy_cleanup)
+      _tempcopy_files.append(os.path.abspath(dst))
+
+  def _tempcopy_cleanup():
+    while _tempcopy_files:
+      filename = _tempcopy_files.pop()
+      if os.path.isfile(filename):
+        os.remove(filename)
+''').lstrip()
+
+_READ_README_CODE = textwrap.dedent('''
+  if os.path.isfile(readme_file):
+    with io.open(readme_file, encoding='utf8') as fp:
+      long_description = fp.read()
+  else:
+    print("warning: file \\"{}\\" does not exist.".format(readme_file), file=sys.stderr)
+    long_description = None
+''').lstrip()
+
+_SETUP_CALL_TEMPLATE = textwrap.dedent('''
+  setuptools.setup(
+    name = %(name)r,
+    version = %(version)r,
+    author = %(author_name)r,
+    author_email = %(author_email)r,
+    description = %(description)r,
+    long_description = %(long_description_expr)s,
+    long_description_content_type = %(long_description_content_type)r,
+    url = %(url)r,
+    license = %(license)r,
+  %(packages_args)s
+    package_dir = {'': %(src_directory)r},
+    include_package_data = %(include_package_data)r,
+    install_requires = requirements,
+    extras_require = %(extras_require)s,
+    tests_require = %(tests_require)s,
+    python_requires = %(python_requires_expr)s,
+    data_files = %(data_files)s,
+    entry_points = %(entry_points)s,
+    cmdclass = %(cmdclass)s,
+    keywords = %(keywords)r,
+    classifiers = %(classifiers)r,
+    zip_safe = %(zip_safe)r,
+''').rstrip()
+
+_UNIVERSAL_OPTIONS_CODE = textwrap.dedent('''
+    options = {
+      'bdist_wheel': {
+        'universal': True,
+      },
+    },
+  )
+''')
+
+
+def _decode_text(data: bytes) -> str:
+  """
+  Decodes *data* and translates newlines the same way as in text mode, such that offsets
+  into the returned string match those of a file opened with #open().
+  """
+
+  text = data.decode('utf8', 'replace')
+  if '\r' in text:
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+  return text
+
+
+def _search_file(filename: str, regex: Pattern, chunk_size: int = 8192) -> Optional[Match]:
+  """
+  Searches for *regex* in the contents of *filename* using raw file descriptor reads. Only
+  the first *chunk_size* bytes are read and searched at first, as that is usually where the
+  match is. The rest of the file is only read if no match was found.
+  """
+
+  fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+  try:
+    data = os.read(fd, chunk_size)
+    match = regex.search(_decode_text(data))
+    if not match and len(data) == chunk_size:
+      data += os.read(fd, max(os.fstat(fd).st_size - chunk_size, 1))
+      match = regex.search(_decode_text(data))
+  finally:
+    os.close(fd)
+  return match
+
 
-def _normpath(x):
-  return os.path.normpath(x).replace(os.sep, '/')
+def _normalize_description(description: str) -> str:
+  """
+  Joins the lines of a paragraph in *description* with spaces and separates paragraphs
+  by a single newline.
+  """
+
+  return _DESCRIPTION_NEWLINE_REGEX.sub(
+    lambda m: ' ' if len(m.group(0)) == 1 else '\n', description).strip()
 
 
 def _get_readme_content_type(filename: str) -> str:
@@ -57,15 +216,23 @@ def _get_readme_content_type(filename: str) -> str:
   }.get(nr.fs.getsuffix(filename), 'text/plain')
 
 
-def _split_section(data, begin_marker, end_marker):
+def _split_section(data: str, begin_marker: str, end_marker: str) -> Tuple[str, str]:
+  """
+  Returns the text before *begin_marker* and after *end_marker* in *data*. A newline that
+  immediately follows the *end_marker* belongs to the section. If the section does not
+  exist, the whole *data* is returned as the prefix.
+  """
+
   start = data.find(begin_marker)
-  end = data.find(end_marker, start)
-  if start >= 0 and end >= 0:
-    prefix = data[:start]
-    middle = data[start+len(begin_marker):end]
-    suffix = data[end+len(end_marker)+1:]
-    return prefix, middle, suffix
-  return (data, '', '')
+  if start < 0:
+    return data, ''
+  end = data.find(end_marker, start + len(begin_marker))
+  if end < 0:
+    return data, ''
+  end += len(end_marker)
+  if data.startswith('\n', end):
+    end += 1
+  return data[:start], data[end:]
 
 
 @contextlib.contextmanager
@@ -74,7 +241,9 @@ def _rewrite_section(fp, data, begin_marker, end_marker):
   Helper to rewrite a section of a file delimited by *begin_marker* and *end_marker*.
   """
 
-  prefix, suffix = _split_section(data, begin_marker, end_marker)[::2]
+  prefix, suffix = _split_section(data, begin_marker, end_marker)
+  if prefix and not prefix.endswith('\n'):
+    prefix += '\n'
   fp.write(prefix)
   fp.write(begin_marker + '\n')
   yield fp
@@ -96,12 +265,31 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
     'python-major-minor-version': 'sys.version[:3]'
   }
 
+  #: Matches any of the #_ENTRTYPOINT_VARS in the form `{{varname}}`.
+  _ENTRYPOINT_VARS_REGEX = re.compile(r'\{\{(' + '|'.join(map(re.escape, _ENTRTYPOINT_VARS)) + r')\}\}')
+
+  def __init__(self) -> None:
+    self._metadata_cache: Dict[int, PythonPackageMetadata] = {}
+    self._readme_status_cache: Dict[int, Optional[_ReadmeStatus]] = {}
+
+  def _get_package_metadata(self, package: PackageModel) -> PythonPackageMetadata:
+    """
+    Returns the #PythonPackageMetadata for *package*. The object is kept for the lifetime of
+    the renderer, so the package entry file is only looked up on disk once.
+    """
+
+    try:
+      return self._metadata_cache[id(package)]
+    except KeyError:
+      metadata = self._metadata_cache[id(package)] = package.get_python_package_metadata()
+      return metadata
+
   def _render_setup(
     self,
     fp: TextIO,
     package: PackageModel,
   ) -> None:
-    metadata = package.get_python_package_metadata()
+    metadata = self._get_package_metadata(package)
     install = package.install
 
     # Write the header/imports.
@@ -111,12 +299,7 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
       fp.write('from setuptools.command.install import install as _install_command\n')
     if install.hooks.before_develop or install.hooks.after_develop:
       fp.write('from setuptools.command.develop import develop as _develop_command\n')
-    fp.write(textwrap.dedent('''
-      import io
-      import os
-      import setuptools
-      import sys
-    ''').lstrip())
+    fp.write(_SETUP_IMPORTS_CODE)
 
     # Write hook overrides.
     cmdclass = {}
@@ -125,43 +308,12 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
       for hook in package.install_hooks:
         fp.write('  ' + json.dumps(hook.normalize().to_json(), sort_keys=True) + ',\n')
       fp.write(']\n')
-      fp.write(textwrap.dedent('''
-        def _run_hooks(event):
-          import subprocess, shlex, os
-          def _shebang(fn):
-            with open(fn) as fp:
-              line = fp.readline()
-              if line.startswith('#'):
-                return shlex.split(line[1:].strip())
-              return []
-          for hook in install_hooks:
-            if not hook['event'] or hook['event'] == event:
-              command = hook['command']
-              if command[0].endswith('.py') or 'python' in _shebang(command[0]):
-                command.insert(0, sys.executable)
-              env = os.environ.copy()
-              env['SHUT_INSTALL_HOOK_EVENT'] = event
-              res = subprocess.call(command, env=env)
-              if res != 0:
-                raise RuntimeError('command {!r} returned exit code {}'.format(command, res))
-      '''))
+      fp.write(_RUN_HOOKS_CODE)
     if install.hooks.after_install or install.hooks.before_install:
-      fp.write(textwrap.dedent('''
-        class install_command(_install_command):
-          def run(self):
-            _run_hooks('install')
-            super(install_command, self).run()
-            _run_hooks('post-install')
-      '''))
+      fp.write(_INSTALL_COMMAND_CODE)
       cmdclass['install'] = 'install_command'
     if install.hooks.before_develop or install.hooks.after_develop:
-      fp.write(textwrap.dedent('''
-        class develop_command(_develop_command):
-          def run(self):
-            _run_hooks('develop')
-            super(develop_command, self).run()
-            _run_hooks('post-develop')
-      '''))
+      fp.write(_DEVELOP_COMMAND_CODE)
       cmdclass['develop'] = 'develop_command'
 
     license_file = package.get_license_file(True)
@@ -176,27 +328,26 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
     readme_file, long_description_expr = self._render_readme_code(fp, package)
 
     # Write the install requirements.
-    fp.write('\n')
-    self._render_requirements(fp, 'requirements', package.requirements)
+    requirements = ['\n', self._render_requirements('requirements', package.requirements)]
 
     if package.test_requirements:
-      self._render_requirements(fp, 'test_requirements', package.test_requirements)
+      requirements.append(self._render_requirements('test_requirements', package.test_requirements))
       tests_require = 'test_requirements'
     else:
       tests_require = '[]'
 
     if package.extra_requirements:
-      fp.write('extras_require = {}\n')
-      for key, value in package.extra_requirements.items():
-        self._render_requirements(fp, 'extras_require[{!r}]'.format(key), value)
+      requirements.append('extras_require = {}\n')
+      requirements.extend(
+        self._render_requirements('extras_require[{!r}]'.format(key), value)
+        for key, value in package.extra_requirements.items())
       extras_require = 'extras_require'
     else:
       extras_require = '{}'
 
-    exclude_packages = []
-    for pkg in package.exclude:
-      exclude_packages.append(pkg)
-      exclude_packages.append(pkg + '.*')
+    fp.writelines(requirements)
+
+    exclude_packages = [name for pkg in package.exclude for name in (pkg, pkg + '.*')]
 
     if metadata.is_single_module:
       packages_args = '  py_modules = [{!r}],'.format(package.get_modulename())
@@ -224,31 +375,7 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
     zip_safe = not package.typed
 
     # Write the setup function.
-    fp.write(textwrap.dedent('''
-      setuptools.setup(
-        name = {name!r},
-        version = {version!r},
-        author = {author_name!r},
-        author_email = {author_email!r},
-        description = {description!r},
-        long_description = {long_description_expr},
-        long_description_content_type = {long_description_content_type!r},
-        url = {url!r},
-        license = {license!r},
-      {packages_args}
-        package_dir = {{'': {src_directory!r}}},
-        include_package_data = {include_package_data!r},
-        install_requires = requirements,
-        extras_require = {extras_require},
-        tests_require = {tests_require},
-        python_requires = {python_requires_expr},
-        data_files = {data_files},
-        entry_points = {entry_points},
-        cmdclass = {cmdclass},
-        keywords = {keywords!r},
-        classifiers = {classifiers!r},
-        zip_safe = {zip_safe!r},
-    ''').rstrip().format(
+    fp.write(_SETUP_CALL_TEMPLATE % dict(
       name=package.name,
       version=str(package.get_version()),
       packages_args=packages_args,
@@ -256,7 +383,7 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
       author_email=package.get_author().email if package.get_author() else None,
       url=package.get_url(),
       license=package.get_license(),
-      description=package.description.replace('\n\n', '%%%%').replace('\n', ' ').replace('%%%%', '\n').strip(),
+      description=_normalize_description(package.description),
       long_description_expr=long_description_expr,
       long_description_content_type=_get_readme_content_type(readme_file) if readme_file else None,
       extras_require=extras_require,
@@ -273,56 +400,69 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
     ))
 
     if package.is_universal():
-      fp.write(textwrap.dedent('''
-          options = {
-            'bdist_wheel': {
-              'universal': True,
-            },
-          },
-        )
-      '''))
+      fp.write(_UNIVERSAL_OPTIONS_CODE)
     else:
       fp.write('\n)\n')
 
-  def _render_entrypoints(self, entrypoints: Dict[str, List[str]]) -> None:
+  def _render_entrypoints(self, entrypoints: Dict[str, List[str]]) -> str:
     if not entrypoints:
       return '{}'
     lines = ['{']
     for key, value in entrypoints.items():
-      lines.append('    {!r}: ['.format(key))
-      for item in value:
-        item = repr(item)
-        args = []
-        for varname, expr in self._ENTRTYPOINT_VARS.items():
-          varname = '{{' + varname + '}}'
-          if varname in item:
-            item = item.replace(varname, '{' + str(len(args)) + '}')
-            args.append(expr)
-        if args:
-          item += '.format(' + ', '.join(args) + ')'
-        lines.append('      ' + item.strip() + ',')
+      lines.append(_ENTRYPOINT_GROUP_LINE(key))
+      lines.extend([_ENTRYPOINT_ITEM_LINE(self._render_entrypoint_expr(item)) for item in value])
       lines.append('    ],')
     lines[-1] = lines[-1][:-1]
     lines.append('  }')
     return '\n'.join(lines)
 
+  def _render_entrypoint_expr(self, entrypoint: str) -> str:
+    """
+    Renders a Python expression for the *entrypoint* string that substitutes the
+    #_ENTRTYPOINT_VARS at setup time.
+    """
+
+    args: List[str] = []
+    placeholders: Dict[str, str] = {}
+
+    def _sub(match):
+      varname = match.group(1)
+      if varname not in placeholders:
+        placeholders[varname] = '{' + str(len(args)) + '}'
+        args.append(self._ENTRTYPOINT_VARS[varname])
+      return placeholders[varname]
+
+    expr = self._ENTRYPOINT_VARS_REGEX.sub(_sub, repr(entrypoint))
+    if args:
+      expr += '.format(' + ', '.join(args) + ')'
+    return expr
+
   @staticmethod
   def _format_reqs(reqs: RequirementsList, level: int = 0) -> List[str]:
     indent = '  ' * (level + 1)
     reqs = [r for r in reqs.reqs() if r.package != 'python']
     if not reqs:
       return '[]'
-    return '[\n' + ''.join(indent + '{!r},\n'.format(x.to_setuptools()) for x in reqs if x.package != 'python') + ']'
+    return '[\n' + ''.join(indent + '{!r},\n'.format(x.to_setuptools()) for x in reqs) + ']'
 
-  def _render_requirements(self, fp: TextIO, target: str, requirements: RequirementsList):
-    fp.write('{} = {}\n'.format(target, self._format_reqs(requirements)))
+  def _render_requirements(self, target: str, requirements: RequirementsList) -> str:
+    return '{} = {}\n'.format(target, self._format_reqs(requirements))
 
   def _get_readme_status(self, package: PackageModel) -> Optional[_ReadmeStatus]:
     """
     Returns some information on the readme for a package. The readme can be located outside
     of the package directory, but that needs to be handled special in various cases.
+
+    The result is cached for the lifetime of the renderer.
     """
 
+    try:
+      return self._readme_status_cache[id(package)]
+    except KeyError:
+      status = self._readme_status_cache[id(package)] = self._find_readme_status(package)
+      return status
+
+  def _find_readme_status(self, package: PackageModel) -> Optional[_ReadmeStatus]:
     readme = package.get_readme_file()
     if not readme:
       return None
@@ -355,16 +495,7 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
     # TODO(NiklasRosenstein): make sure this gets rendered into the file only once.
 
     fp.write('\n')
-    fp.write(textwrap.dedent('''
-      def _tempcopy(src, dst):
-        import atexit, shutil
-        if not os.path.isfile(dst):
-          if not os.path.isfile(src):
-            print('warning: source file "{}" for destination "{}" does not exist'.format(src, dst))
-            return
-          shutil.copyfile(src, dst)
-          atexit.register(lambda: os.remove(dst))
-    ''').lstrip())
+    fp.write(_TEMPCOPY_FUNCTION_CODE)
     fp.write('\n')
 
   def _render_readme_code(self, fp: TextIO, package: PackageModel) -> Tuple[Optional[str], Optional[str]]:
@@ -393,14 +524,7 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
       fp.write('_tempcopy({!r}, readme_file)\n'.format(readme.path))
 
     # Read the contents of the file into the "long_description" variable.
-    fp.write(textwrap.dedent('''
-      if os.path.isfile(readme_file):
-        with io.open(readme_file, encoding='utf8') as fp:
-          long_description = fp.read()
-      else:
-        print("warning: file \\"{}\\" does not exist.".format(readme_file), file=sys.stderr)
-        long_description = None
-    ''').lstrip())
+    fp.write(_READ_README_CODE)
 
     return readme.path, 'long_description'
 
@@ -420,21 +544,19 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
     if readme:
       files.append(readme.path)
 
-    manifest = [
-      os.path.relpath(os.path.abspath(f), package.get_directory())
-      for f in files
-      if f
-    ]
-
     # Paths outside of the package directory are copied into the package directory
     # on setup.py.
-    manifest = [
-      os.path.basename(f) if f.startswith(os.pardir + os.sep) else f
-      for f in manifest
-    ]
-
-    manifest = ['include ' + s for s in manifest]
-    metadata = package.get_python_package_metadata()
+    directory = package.get_directory()
+    outside_prefix = os.pardir + os.sep
+    manifest = []
+    for filename in filter(None, files):
+      filename = os.path.relpath(os.path.abspath(filename), directory)
+      if filename.startswith(outside_prefix):
+        filename = os.path.basename(filename)
+      manifest.append('include ' + filename)
+
+    package_data_directory = posixpath.join(
+      package.source_directory, package.get_modulename().replace('.', '/'))
     for entry in package.package_data:
       if isinstance(entry, Include):
         verb = 'include'
@@ -444,13 +566,11 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
         path = entry.exclude
       else:
         raise RuntimeError(f'unexpected package_data entry: {entry!r}')
-      path = posixpath.join(package.source_directory, package.get_modulename().replace('.', '/'), path)
-      manifest.append(f'{verb} {path}')
+      manifest.append(f'{verb} {posixpath.join(package_data_directory, path)}')
 
     markers = (self._BEGIN_SECTION, self._END_SECTION)
     with _rewrite_section(fp, current.read() if current else '', *markers):
-      for entry in manifest:
-        fp.write(entry + '\n')
+      fp.write(''.join(entry + '\n' for entry in manifest))
 
   # Renderer[PackageModel] Overrides
 
@@ -459,7 +579,7 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
     files.add_dynamic('MANIFEST.in', self._render_manifest_in, package, inplace=True)
 
     if package.typed:
-      directory = package.get_python_package_metadata().package_directory
+      directory = self._get_package_metadata(package).package_directory
       files.add_static(os.path.join(directory, 'py.typed'), '')
 
     if package.has_vendored_requirements():
@@ -467,19 +587,17 @@ class SetuptoolsRenderer(Renderer[PackageModel]):
         'being published.', package.name)
 
   def get_version_refs(self, package: PackageModel) -> Iterable[VersionRef]:
-    def _regex_refs(filename: Optional[str], regex: str) -> Iterable[VersionRef]:
+    def _regex_refs(filename: Optional[str], regex: Pattern) -> Iterable[VersionRef]:
       if filename and os.path.isfile(filename):
-        with open(filename) as fp:
-          text = fp.read()
-          match = re.search(regex, text, re.M)
-          if match:
-            yield VersionRef(filename, match.start(1), match.end(1), match.group(1))
+        match = _search_file(filename, regex)
+        if match:
+          yield VersionRef(filename, match.start(1), match.end(1), match.group(1))
 
     filename = os.path.join(package.get_directory(), 'setup.py')
-    yield from _regex_refs(filename, r'^\s*version\s*=\s*[\'"]([^\'"]+)[\'"]')
+    yield from _regex_refs(filename, _SETUP_VERSION_REGEX)
 
-    filename = package.get_python_package_metadata().filename
-    yield from _regex_refs(filename, r'^__version__\s*=\s*[\'"]([^\'"]+)[\'"]')
+    filename = self._get_package_metadata(package).filename
+    yield from _regex_refs(filename, _PACKAGE_VERSION_REGEX)
 
 
 register_renderer(PackageModel, SetuptoolsRenderer)
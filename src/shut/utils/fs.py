@@ -5,19 +5,42 @@ import typing as t
 
 def get_file_in_directory(directory: str, prefix: str, preferred: t.List[str]) -> t.Optional[str]:
   """
-  Returns a file in *directory* that is either in the *preferred* list or starts with
-  specified *prefix*.
+  Returns the path of a file in *directory* that is either in the *preferred* list or starts
+  with specified *prefix*. If multiple files match, the first by name is returned, with files
+  from the *preferred* list taking precedence. The returned path is always joined with
+  *directory*, also for files that only match the *prefix*. The directory is read with a
+  single #os.scandir() pass.
   """
 
-  choices = []
-  for name in sorted(os.listdir(directory)):
-    if name in preferred:
-      break
-    if name.startswith(prefix):
-      choices.append(name)
-  else:
-    if choices:
-      return choices[0]
-    return None
-
-  return os.path.join(directory, name)
+  preferred_names = set(preferred)
+  best_preferred: t.Optional[str] = None
+  best_prefixed: t.Optional[str] = None
+
+  with os.scandir(directory) as entries:
+    for entry in entries:
+      name = entry.name
+      if name in preferred_names:
+        if (best_preferred is None or name < best_preferred) and entry.is_file():
+          best_preferred = name
+      elif name.startswith(prefix):
+        if (best_prefixed is None or name < best_prefixed) and entry.is_file():
+          best_prefixed = name
+
+  result = best_preferred or best_prefixed
+  return os.path.join(directory, result) if result else None
+
+
+def remove_directory(directory: str) -> None:
+  """
+  Removes *directory* and all of its contents. Uses the file type information returned by
+  #os.scandir() to tell files and directories apart without additional stat calls, which is
+  cheap for the small, flat directories (like `dist/`) that this is usually used on.
+  """
+
+  with os.scandir(directory) as entries:
+    for entry in entries:
+      if entry.is_dir(follow_symlinks=False):
+        remove_directory(entry.path)
+      else:
+        os.unlink(entry.path)
+  os.rmdir(directory)
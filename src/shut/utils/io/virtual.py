@@ -22,7 +22,21 @@
 import contextlib
 import io
 import os
-from typing import Any, Callable, ContextManager, IO, Iterable, Optional, Set, Union
+from typing import Any, Callable, ContextManager, Dict, IO, Iterable, Optional, Set, Union
+
+
+def _write_bytes(filename: str, data: bytes) -> None:
+  """
+  Writes *data* to *filename* through a raw file descriptor, replacing any existing contents.
+  """
+
+  fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+  try:
+    view = memoryview(data)
+    while view:
+      view = view[os.write(fd, view):]
+  finally:
+    os.close(fd)
 
 
 class VirtualFiles:
@@ -79,9 +93,6 @@ class VirtualFiles:
     *parent_directory*.
     """
 
-    if open_func is None:
-      open_func = open
-
     for file_, filename in zip(self._files, self.abspaths(parent_directory)):
       exists = os.path.isfile(filename)
       if exists and not overwrite:
@@ -94,7 +105,9 @@ class VirtualFiles:
         mode = '' if file_['text'] else 'b'
         if create_directories:
           os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
-        if file_['inplace']:
+        if open_func is None:
+          _write_bytes(filename, self._render(file_, filename if exists else None))
+        elif file_['inplace']:
           with open_func(filename, 'w' + mode) as dst:
             if exists:
               # TODO: This needs to use an atomic file actually..
@@ -106,6 +119,36 @@ class VirtualFiles:
           with open_func(filename, 'w' + mode) as dst:
             file_['render_func'](dst, *file_['args'])
 
+  @staticmethod
+  def _render(file_: Dict[str, Any], current_filename: Optional[str]) -> bytes:
+    """
+    Renders *file_* into memory and returns the encoded contents. In-place files receive
+    the current contents of *current_filename*, which is read before the file is replaced.
+    """
+
+    if not file_['text']:
+      binary_buffer = io.BytesIO()
+      VirtualFiles._render_into(binary_buffer, file_, current_filename, 'rb')
+      return binary_buffer.getvalue()
+
+    text_buffer = io.StringIO()
+    VirtualFiles._render_into(text_buffer, file_, current_filename, 'r')
+    content = text_buffer.getvalue()
+    if os.linesep != '\n':
+      content = content.replace('\n', os.linesep)
+    return content.encode('utf8')
+
+  @staticmethod
+  def _render_into(fp: IO, file_: Dict[str, Any], current_filename: Optional[str], mode: str) -> None:
+    if file_['inplace']:
+      if current_filename:
+        with open(current_filename, mode) as src:
+          file_['render_func'](fp, src, *file_['args'])
+      else:
+        file_['render_func'](fp, None, *file_['args'])
+    else:
+      file_['render_func'](fp, *file_['args'])
+
   def abspaths(self, parent_directory: str = None) -> Iterable[str]:
     """
     Returns all paths in this virtual fileset joined with *parent_directory*.
@@ -0,0 +1,37 @@
+
+import os
+
+from shut.builders import get_builders
+from shut.model import Project
+from shut.renderers import get_files
+
+
+def test_build_package_twice_in_same_process(tmp_path):
+  package_dir = tmp_path / 'foo'
+  (package_dir / 'src' / 'foo').mkdir(parents=True)
+  (package_dir / 'src' / 'foo' / '__init__.py').write_text("__version__ = '1.2.3'\n")
+  (package_dir / 'package.yml').write_text(
+    'name: foo\nversion: 1.2.3\nauthor: John Doe <john@example.com>\nlicense: MIT\n'
+    'description: Test package.\nreadme: ../README.md\n')
+  (tmp_path / 'README.md').write_text('This file must survive the build.\n')
+
+  package = Project().load(str(package_dir))
+  get_files(package).write_all(str(package_dir))
+  builders = list(get_builders(package))
+  assert builders
+
+  cwd = os.getcwd()
+  os.chdir(str(tmp_path))
+  try:
+    for round_ in range(2):
+      build_dir = tmp_path / 'build-{}'.format(round_)
+      build_dir.mkdir()
+      for builder in builders:
+        assert builder.build(str(build_dir), False), (round_, builder)
+      assert sorted(os.listdir(str(build_dir))) == sorted(builder.get_outputs()[0] for builder in builders)
+      assert not (package_dir / 'README.md').exists()
+  finally:
+    os.chdir(cwd)
+
+  assert (tmp_path / 'README.md').is_file()
+  assert not (package_dir / 'dist').exists()
@@ -0,0 +1,17 @@
+
+from shut.renderers.setuptools import _normalize_description, _split_section
+
+
+def test_normalize_description():
+  assert _normalize_description('Foo\nbar.\n') == 'Foo bar.'
+  assert _normalize_description('Foo\nbar.\n\nSpam\neggs.') == 'Foo bar.\nSpam eggs.'
+  assert _normalize_description('Keeps %%%% as is.\n\n\nok') == 'Keeps %%%% as is.\n ok'
+
+
+def test_split_section():
+  begin, end = '# {', '# }'
+  assert _split_section('a\n# {\nb\n# }\nc\n', begin, end) == ('a\n', 'c\n')
+  assert _split_section('a\n# {\nb\n# }', begin, end) == ('a\n', '')
+  assert _split_section('a\n# {\nb\n# }c', begin, end) == ('a\n', 'c')
+  assert _split_section('a\n# {\nb\n', begin, end) == ('a\n# {\nb\n', '')
+  assert _split_section('a\n', begin, end) == ('a\n', '')
@@ -0,0 +1,15 @@
+
+from shut.utils.fs import get_file_in_directory
+
+
+def test_get_file_in_directory(tmp_path):
+  preferred = ['README.md', 'README.rst']
+  assert get_file_in_directory(str(tmp_path), 'README.', preferred) is None
+
+  (tmp_path / 'README.adoc').touch()
+  (tmp_path / 'README.txt').touch()
+  assert get_file_in_directory(str(tmp_path), 'README.', preferred) == str(tmp_path / 'README.adoc')
+
+  (tmp_path / 'README.rst').touch()
+  (tmp_path / 'README.md').mkdir()
+  assert get_file_in_directory(str(tmp_path), 'README.', preferred) == str(tmp_path / 'README.rst')